@@ -2,30 +2,108 @@
 """
 Ionosphere repository build orchestration.
 """
-from enum import Enum
-from logging import basicConfig as log_config, getLogger, DEBUG
-from os import link, lstat, mkdir, walk
-from os.path import abspath, exists, join as path_join, split as path_split
+from asyncio import Event as AsyncEvent, gather, run as asyncio_run
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from enum import Enum, IntEnum
+from io import BytesIO, TextIOWrapper
+from logging import Formatter, StreamHandler, getLogger, DEBUG
+from logging.handlers import QueueHandler, QueueListener
+from functools import cached_property
+from os import (
+    close as os_close, makedirs, mkdir, pipe as os_pipe)
+from os.path import (
+    abspath, dirname, exists, getmtime, getsize, join as path_join,
+    split as path_split)
+from pickle import (
+    dump as pickle_dump, load as pickle_load, UnpicklingError)
 from platform import machine, system as system_name
-from re import compile as re_compile
-from shutil import copy2, rmtree
+from shutil import copyfileobj
+from queue import SimpleQueue
 from sys import argv
-from tempfile import mkdtemp
+from tarfile import open as tarfile_open
+from tempfile import SpooledTemporaryFile
 from threading import Condition, local
 from typing import (
-    Any, Callable, Dict, Iterable, List, NamedTuple, Optional, Sequence)
+    Any, Dict, IO, Iterable, List, Optional, Sequence)
 from urllib.parse import unquote_plus as url_unquote_plus, urlparse
 
 import docker
 from docker.errors import BuildError, ContainerError
 from docker.models.images import Image
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import yaml
 
+try:
+    # Linux-only (and Python 3.10+); used for zero-copy downloads over
+    # plain HTTP.
+    from os import splice as os_splice
+except ImportError:
+    os_splice = None
+
+try:
+    # Optional; enables the async download pre-pass in main.
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+try:
+    # Optional; enables the io_uring write path for large downloads.
+    import liburing
+except ImportError:
+    liburing = None
+
+try:
+    # The libyaml-backed loader parses identically to the pure-Python one,
+    # just several times faster; PyYAML only provides it when built against
+    # libyaml.
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+
 # pylint: disable=invalid-name,too-many-instance-attributes,too-many-arguments
 
-READ_BUFFER_SIZE = 1 << 20
-LOG_STRIP_PATTERN = re_compile(r"^(?:[ \n]*\n)?((?:.|\n+.)*)(?:\n[ \n]*)?$")
+READ_BUFFER_SIZE = 1 << 22
+
+# The host architecture and OS never change within a process; platform's
+# accessors query the OS, so capture them once at import.
+MACHINE_ARCH = machine()
+SYSTEM_NAME = system_name()
+URING_BUFFER_SIZE = 1 << 20
+URING_QUEUE_DEPTH = 8
+URING_MIN_DOWNLOAD_SIZE = 32 << 20
+CONTEXT_SPOOL_SIZE = 32 << 20
+LOG_TAIL_LINES = 200
+
+
+def tail_lines(data: bytes, max_lines: int = LOG_TAIL_LINES) -> str:
+    """
+    Decode the last max_lines lines of data. A failing container can emit
+    megabytes of output; this streams the decode line-by-line and keeps
+    only the tail, rather than materializing the whole decoded text.
+    """
+    lines: deque = deque(
+        TextIOWrapper(BytesIO(data), encoding="utf-8", errors="replace"),
+        maxlen=max_lines)
+    return "".join(lines).strip(" \n")
+
+
+def create_http_session() -> requests.Session:
+    """
+    Create a requests Session with connection pooling and retries for
+    downloading source archives. Many packages share hosts (GitHub, PyPI
+    mirrors), so reusing connections avoids a TCP+TLS handshake per
+    download.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=16, pool_maxsize=8,
+        max_retries=Retry(3, backoff_factor=0.2))
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
 
 log = getLogger("ionosphere.repobuild")
 
@@ -45,7 +123,7 @@ class Package:
         self.download_url = download_url
         self.dependencies = dict(dependencies)
 
-    @property
+    @cached_property
     def source_archive_name(self) -> str:
         """
         The base filename of the source archive.
@@ -53,15 +131,14 @@ class Package:
         return path_split(
             url_unquote_plus(urlparse(self.resolved_download_url).path))[-1]
 
-    @property
+    @cached_property
     def resolved_download_url(self) -> str:
         """
         The download_url resolved with variables replaced.
         """
-        arch = machine()
         return self.download_url.format(
-            Arch=arch, Architecture=arch, Name=self.name,
-            System=system_name(), Version=self.version)
+            Arch=MACHINE_ARCH, Architecture=MACHINE_ARCH, Name=self.name,
+            System=SYSTEM_NAME, Version=self.version)
 
     @classmethod
     def from_yaml_config(cls, config: Dict[str, Any]) -> "Package":
@@ -74,6 +151,39 @@ class Package:
                    dependencies=dependencies)
 
 
+def load_packages(path: str) -> List[Package]:
+    """
+    Load the package manifest, keeping a pickle sidecar cache keyed by the
+    manifest's mtime and size so repeat invocations skip YAML parsing
+    entirely.
+    """
+    cache_path = path + ".cache"
+    key = (getmtime(path), getsize(path))
+
+    try:
+        with open(cache_path, "rb") as fd:
+            cached_key, packages = pickle_load(fd)
+        if cached_key == key:
+            return packages
+    except (OSError, UnpicklingError, EOFError, ValueError):
+        pass
+
+    with open(path, "r") as fd:
+        package_infos = yaml.load(fd, Loader=YamlLoader)
+
+    packages = [
+        Package.from_yaml_config(package_info)
+        for package_info in package_infos]
+
+    try:
+        with open(cache_path, "wb") as fd:
+            pickle_dump((key, packages), fd)
+    except OSError:
+        pass
+
+    return packages
+
+
 class PackageType(Enum):
     """
     Type of package being produced (RPM or DEB).
@@ -82,41 +192,40 @@ class PackageType(Enum):
     DEB = "deb"
 
 
-class PlatformInfo(NamedTuple):
-    """
-    Variables for a given platform to build for.
-    """
-    name: str
-    arch: str
-    source_docker_image: str
-    package_type: PackageType
+# Per-platform attributes, stored as parallel tuples indexed by the
+# Platform enum value so each Platform property is a single tuple index
+# instead of an attribute chain through the enum value.
+PLATFORM_OS_NAMES = (
+    "amzn1", "amzn2", "el7", "ubuntu-xenial", "ubuntu-bionic",
+    "ubuntu-cosmic", "ubuntu-disco")
+PLATFORM_ARCHES = (
+    "x86_64", "x86_64", "x86_64", "amd64", "amd64", "amd64", "amd64")
+PLATFORM_SOURCE_DOCKER_IMAGES = (
+    "amazonlinux:1", "amazonlinux:2", "centos:7", "ubuntu:16.04",
+    "ubuntu:18.04", "ubuntu:18.10", "ubuntu:19.04")
+PLATFORM_PACKAGE_TYPES = (
+    PackageType.RPM, PackageType.RPM, PackageType.RPM, PackageType.DEB,
+    PackageType.DEB, PackageType.DEB, PackageType.DEB)
 
 
-class Platform(Enum):
+class Platform(IntEnum):
     """
     Platforms we know how to build against.
     """
-    amzn1_x86_64 = PlatformInfo(
-        "amzn1", "x86_64", "amazonlinux:1", PackageType.RPM)
-    amzn2_x86_64 = PlatformInfo(
-        "amzn2", "x86_64", "amazonlinux:2", PackageType.RPM)
-    el7_x86_64 = PlatformInfo(
-        "el7", "x86_64", "centos:7", PackageType.RPM)
-    ubuntu_1604_x86_64 = PlatformInfo(
-        "ubuntu-xenial", "amd64", "ubuntu:16.04", PackageType.DEB)
-    ubuntu_1804_x86_64 = PlatformInfo(
-        "ubuntu-bionic", "amd64", "ubuntu:18.04", PackageType.DEB)
-    ubuntu_1810_x86_64 = PlatformInfo(
-        "ubuntu-cosmic", "amd64", "ubuntu:18.10", PackageType.DEB)
-    ubuntu_1904_x86_64 = PlatformInfo(
-        "ubuntu-disco", "amd64", "ubuntu:19.04", PackageType.DEB)
+    amzn1_x86_64 = 0
+    amzn2_x86_64 = 1
+    el7_x86_64 = 2
+    ubuntu_1604_x86_64 = 3
+    ubuntu_1804_x86_64 = 4
+    ubuntu_1810_x86_64 = 5
+    ubuntu_1904_x86_64 = 6
 
     @property
     def os_name(self) -> str:
         """
         The short OS name (amzn1, amzn2, el7, etc.); used in RPM suffixes.
         """
-        return self.value.name              # pylint: disable=no-member
+        return PLATFORM_OS_NAMES[self]
 
     @property
     def arch(self) -> str:
@@ -124,21 +233,21 @@ class Platform(Enum):
         The processor architecture; used in package names (OS-specific;
         notably RPM-based OSes use x86_64, while DEB-based OSes use amd64).
         """
-        return self.value.arch              # pylint: disable=no-member
+        return PLATFORM_ARCHES[self]
 
     @property
     def source_docker_image(self) -> str:
         """
         The Docker image used for building.
         """
-        return self.value.source_docker_image  # pylint: disable=no-member
+        return PLATFORM_SOURCE_DOCKER_IMAGES[self]
 
     @property
     def package_type(self) -> PackageType:
         """
         The type of packages (RPM, DEB) used by the OS.
         """
-        return self.value.package_type      # pylint: disable=no-member
+        return PLATFORM_PACKAGE_TYPES[self]
 
     @property
     def dockerfile_template(self) -> str:
@@ -157,6 +266,99 @@ class SourcePackageState(Enum):
     Failed = 3
 
 
+class UringWriter:
+    """
+    io_uring-backed writer for sinking large HTTP responses to disk.
+
+    Fills a set of registered fixed buffers from the source stream, then
+    submits one batched write per set, so up to URING_QUEUE_DEPTH writes
+    cost a single io_uring_enter syscall instead of one write(2) each.
+    A writer owns one ring and its buffers and may be reused for any
+    number of files, but only by the thread that created it.
+    """
+    def __init__(self) -> None:
+        """
+        Create a new UringWriter, initializing the ring and registering
+        its fixed buffers. Raises OSError when the kernel does not support
+        io_uring.
+        """
+        super(UringWriter, self).__init__()
+        self.initialized = False
+        self.ring = liburing.io_uring()
+        liburing.io_uring_queue_init(URING_QUEUE_DEPTH, self.ring, 0)
+        self.initialized = True
+        self.buffers = [
+            bytearray(URING_BUFFER_SIZE) for _ in range(URING_QUEUE_DEPTH)]
+        self.iovecs = liburing.iovec(*self.buffers)
+        liburing.io_uring_register_buffers(
+            self.ring, self.iovecs, len(self.buffers))
+
+    def __del__(self):
+        """
+        Tear down the ring. When __init__ failed before the ring was set
+        up -- e.g. io_uring_queue_init returning EPERM or ENOSYS under a
+        seccomp-confined kernel -- there is nothing to exit, and exiting
+        an uninitialized ring is undefined behavior in liburing.
+        """
+        if self.initialized:
+            liburing.io_uring_queue_exit(self.ring)
+
+    def write_stream(self, out_fd: int, stream) -> int:
+        """
+        Write the contents of stream (anything supporting readinto) to the
+        file descriptor out_fd, returning the number of bytes written.
+        """
+        total_written = 0
+
+        while True:
+            # Fill as many fixed buffers as the stream can provide, then
+            # submit the whole batch at once. Completions are reaped before
+            # the buffers are refilled, so in-flight writes never share a
+            # buffer.
+            batch = []
+            for index in range(URING_QUEUE_DEPTH):
+                n_read = stream.readinto(self.buffers[index])
+                if not n_read:
+                    break
+                batch.append((index, n_read))
+
+            if not batch:
+                return total_written
+
+            # Tag each SQE with its buffer index so completions -- which
+            # the kernel may deliver in any order -- can be matched back to
+            # the length submitted for that buffer.
+            offset = total_written
+            batch_lengths: Dict[int, int] = {}
+            for index, length in batch:
+                sqe = liburing.io_uring_get_sqe(self.ring)
+                liburing.io_uring_prep_write_fixed(
+                    sqe, out_fd, self.iovecs[index].iov_base, length,
+                    offset, index)
+                sqe.user_data = index
+                batch_lengths[index] = length
+                offset += length
+
+            liburing.io_uring_submit_and_wait(self.ring, len(batch))
+
+            cqe = liburing.io_uring_cqe()
+            for _ in batch:
+                liburing.io_uring_wait_cqe(self.ring, cqe)
+                n_written = liburing.trap_error(cqe.res)
+                expected = batch_lengths[cqe.user_data]
+                liburing.io_uring_cqe_seen(self.ring, cqe)
+                # A partial completion (ENOSPC, quota) is not an errno;
+                # accepting it would leave a hole at this buffer's offset
+                # while later batches write past it.
+                if n_written != expected:
+                    raise OSError(
+                        f"Short write to fd {out_fd}: wrote {n_written} of "
+                        f"{expected} bytes at batch offset {total_written}")
+
+            for _, length in batch:
+                total_written += length
+
+
 class PackageBuild:
     """
     Build orchestration for a single package.
@@ -164,37 +366,45 @@ class PackageBuild:
     thread_local = local()
     source_state: Dict[str, SourcePackageState] = {}
     download_cond = Condition()
+    http = create_http_session()
 
     def __init__(
-            self, package: Package, platform: Platform, build_root: str,
-            package_root: str, remove_build_dir: bool = True) -> None:
+            self, package: Package, platform: Platform,
+            package_root: str) -> None:
         """
-        Create a new PackageBuild instance. This also creates the temporary
-        build directory used for creating the Docker image.
+        Create a new PackageBuild instance.
         """
         super(PackageBuild, self).__init__()
         self.package = package
         self.platform = platform
-        self.build_root = build_root
         self.package_root = package_root
         self.package_dir = path_join(package_root, package.name)
-        self.build_dir = abspath(mkdtemp(
-            prefix=(f'{package.name.replace("/", "-")}-'
-                    f'{package.version.replace("/", "-")}-{platform.name}-'
-                    f'{platform.arch}'),
-            dir=build_root))
-        self.remove_build_dir = remove_build_dir
+        self.context: Optional[IO[bytes]] = None
         self.staged = False
         self.image: Optional[Image] = None
 
-    def __del__(self):
+    def close(self) -> None:
+        """
+        Release the in-memory build context. Safe to call more than once.
+        """
+        if self.context is not None:
+            self.context.close()
+            self.context = None
+            self.staged = False
+
+    def __enter__(self) -> "PackageBuild":
         """
-        Perform cleanup operations on the PackageBuild instance. If
-        remove_build_dir is set, this will remove the build directory created
-        during initialization.
+        Enter the context.
         """
-        if self.remove_build_dir:
-            rmtree(self.build_dir)
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback) -> None:
+        """
+        Exit the context, releasing the build context buffer. Doing this
+        here makes the release deterministic -- at the end of the with
+        block -- instead of whenever the collector reaps the instance.
+        """
+        self.close()
 
     @property
     def docker(self):
@@ -210,24 +420,142 @@ class PackageBuild:
         return result
 
     @property
+    def uring_writer(self) -> Optional[UringWriter]:
+        """
+        A thread-local io_uring writer, or None when the liburing bindings
+        are not installed or the kernel lacks io_uring support.
+        """
+        try:
+            result = PackageBuild.thread_local.uring_writer
+        except AttributeError:
+            if liburing is None:
+                result = None
+            else:
+                try:
+                    result = UringWriter()
+                except OSError:
+                    result = None
+
+            PackageBuild.thread_local.uring_writer = result
+
+        return result
+
+    @cached_property
     def source_archive_path(self) -> str:
         """
         The full path to the downloaded source archive.
         """
         return path_join(self.package_dir, self.package.source_archive_name)
 
+    def remote_content_length(self, url: str) -> Optional[int]:
+        """
+        The size of the archive as reported by a HEAD request against its
+        download URL, or None if the server does not report one.
+        """
+        try:
+            resp = self.http.head(url, allow_redirects=True)
+            resp.raise_for_status()
+            content_length = resp.headers.get("Content-Length")
+            if content_length is None:
+                return None
+            return int(content_length)
+        except (requests.RequestException, ValueError):
+            return None
+
+    @staticmethod
+    def splice_response_to_file(req: requests.Response, fd) -> bool:
+        """
+        Move the response body from the underlying socket to fd in-kernel
+        via splice(2), avoiding the userspace copy entirely. Returns True
+        on success. Returns False -- without consuming any of the response
+        -- when the transfer cannot be done zero-copy: TLS (the socket
+        carries ciphertext), chunked or content-encoded responses (the
+        socket carries framing/compressed bytes), or platforms without
+        os.splice.
+        """
+        if os_splice is None:
+            return False
+
+        if urlparse(req.url).scheme != "http":
+            return False
+
+        headers = req.headers
+        if (headers.get("Content-Encoding")
+                or headers.get("Transfer-Encoding") == "chunked"
+                or "Content-Length" not in headers):
+            return False
+
+        try:
+            # http.client reads the headers through a buffered reader over
+            # the socket, so some body bytes may already be in userspace.
+            source = req.raw._fp.fp             # pylint: disable=protected-access
+            source_fd = source.fileno()
+        except (AttributeError, OSError):
+            return False
+
+        remaining = int(headers["Content-Length"])
+
+        # Drain whatever the buffered reader already holds past the headers.
+        # The prefix must be flushed before the splice loop: splice writes at
+        # the OS-level file offset, so anything still sitting in fd's
+        # userspace buffer would otherwise be flushed after the spliced body
+        # and corrupt the file.
+        if remaining > 0:
+            buffered = source.read1(remaining)
+            fd.write(buffered)
+            fd.flush()
+            remaining -= len(buffered)
+
+        # splice requires a pipe on one side; socket -> pipe -> file.
+        pipe_read, pipe_write = os_pipe()
+        try:
+            while remaining > 0:
+                moved = os_splice(
+                    source_fd, pipe_write, min(remaining, READ_BUFFER_SIZE))
+                if moved == 0:
+                    raise OSError(
+                        f"Connection closed with {remaining} bytes of "
+                        f"{headers['Content-Length']} unread")
+
+                while moved > 0:
+                    written = os_splice(pipe_read, fd.fileno(), moved)
+                    moved -= written
+                    remaining -= written
+        finally:
+            os_close(pipe_read)
+            os_close(pipe_write)
+
+        return True
+
     def download_source_package(self) -> bool:
         """
         Download the package if it does not already exist. The return value
         indicates if a download was made.
         """
+        url = self.package.resolved_download_url
+
+        # Skip the HEAD request when the download pre-pass (or another
+        # build) already fetched this archive.
+        with self.download_cond:
+            if self.source_state.get(url) == SourcePackageState.Downloaded:
+                return False
+
+        # If a previous run already left the archive on disk with the size
+        # the server reports, skip the download entirely.
+        expected_size = self.remote_content_length(url)
+        if (expected_size is not None and exists(self.source_archive_path)
+                and getsize(self.source_archive_path) == expected_size):
+            log.debug("Already downloaded %s (%d bytes)", url, expected_size)
+            with self.download_cond:
+                self.source_state[url] = SourcePackageState.Downloaded
+            return False
+
         while True:
             with self.download_cond:
-                state = self.source_state.get(self.package.name)
+                state = self.source_state.get(url)
                 if state is None or state == SourcePackageState.Failed:
                     # No download in progress; do it.
-                    self.source_state[self.package.name] = \
-                        SourcePackageState.InProgress
+                    self.source_state[url] = SourcePackageState.InProgress
                     break
 
                 if state == SourcePackageState.Downloaded:
@@ -244,37 +572,30 @@ class PackageBuild:
             if not exists(self.package_dir):
                 mkdir(self.package_dir)
 
-            log.debug("Downloading %s", self.package.resolved_download_url)
-            with requests.get(
-                    self.package.resolved_download_url, stream=True) as req:
+            log.debug("Downloading %s", url)
+            with self.http.get(url, stream=True) as req:
+                # copyfileobj runs the read/write loop in C; decode_content
+                # keeps the transparent decompression iter_content performed.
+                req.raw.decode_content = True
                 with open(self.source_archive_path, "wb") as fd:
-                    for chunk in req.iter_content(chunk_size=READ_BUFFER_SIZE):
-                        fd.write(chunk)
+                    if not self.splice_response_to_file(req, fd):
+                        writer = self.uring_writer
+                        if (writer is not None and expected_size is not None
+                                and expected_size >= URING_MIN_DOWNLOAD_SIZE):
+                            writer.write_stream(fd.fileno(), req.raw)
+                        else:
+                            copyfileobj(req.raw, fd, length=READ_BUFFER_SIZE)
             with self.download_cond:
-                self.source_state[self.package.name] = (
-                    SourcePackageState.Downloaded)
+                self.source_state[url] = SourcePackageState.Downloaded
+                self.download_cond.notify_all()
             return True
         except:                                     # noqa
             with self.download_cond:
-                self.source_state[self.package.name] = (
-                    SourcePackageState.Failed)
+                self.source_state[url] = SourcePackageState.Failed
+                self.download_cond.notify_all()
             raise
 
-    @property
-    def staged_archive(self) -> str:
-        """
-        The path to the staged source archive.
-        """
-        return path_join(self.build_dir, self.package.source_archive_name)
-
-    @property
-    def staged_dockerfile(self) -> str:
-        """
-        The path to the staged Dockerfile.
-        """
-        return path_join(self.build_dir, "Dockerfile")
-
-    @property
+    @cached_property
     def buildargs(self) -> Dict[str, str]:
         """
         The build arguments to pass to Docker while building the image.
@@ -289,61 +610,41 @@ class PackageBuild:
             "VERSION": self.package.version,
         }
 
-    def stage_files(self) -> None:
+    def build_context(self) -> IO[bytes]:
         """
-        Copy files from the source directory to the staging directory.
+        Create the tar build context streamed to the Docker daemon: the
+        contents of the package directory, the source archive, and the
+        platform's Dockerfile. The daemon would tar an on-disk context
+        itself anyway, so building the tar directly skips a full copy of
+        the source tree to a staging directory. Contexts stay in memory up
+        to CONTEXT_SPOOL_SIZE and spool to disk beyond that, keeping peak
+        memory bounded with many large builds in flight.
         """
-        self.download_source_package()
+        buf: IO[bytes] = SpooledTemporaryFile(max_size=CONTEXT_SPOOL_SIZE)
 
-        # Are the package directory and build directory on the same filesystem?
-        # If so, just create hard-links to save on disk space and run faster.
-        package_dev = lstat(self.package.name).st_dev
-        build_dev = lstat(self.build_dir).st_dev
-        if package_dev == build_dev:
-            log.debug("Package directory and build directory reside on the "
-                      "same filesystem; using link to copy files")
-            copy_function: Callable[[str, str], Any] = link
-        else:
-            log.debug("Package directory and build directory reside on "
-                      "different filesystems (%d vs %d); using copy2 to "
-                      "copy files", package_dev, build_dev)
-            copy_function = copy2
-
-        # Copy the bits in the package directory so they're available to the
-        # Docker builder.
-        log.debug("Copying (recursively) %s to %s", self.package.name,
-                  self.build_dir)
-
-        # We can't use copytree here -- it insists on build_dir not existing,
-        # which is problematic for us.
-        package_source = abspath(self.package.name)
-        for source_dir, subdirs, filenames in walk(package_source):
-            target_dir = path_join(
-                self.build_dir, source_dir[len(package_source):].lstrip("/"))
-
-            for filename in filenames:
-                source_path = path_join(source_dir, filename)
-                target_path = path_join(target_dir, filename)
-                log.debug("Copying %s to %s", source_path, target_path)
-                copy_function(source_path, target_path)
-
-            for subdir in subdirs:
-                target_path = path_join(target_dir, subdir)
-                log.debug("Creating %s", target_path)
-                mkdir(target_path)
-
-        # Copy the package itself.
-        log.debug("Copying %s to %s", self.source_archive_path,
-                  self.staged_archive)
-        copy_function(
-            abspath(self.source_archive_path), self.staged_archive)
-
-        # Copy the Dockerfile.
-        log.debug("Copying %s to %s", self.platform.dockerfile_template,
-                  self.staged_dockerfile)
-        copy_function(
-            abspath(self.platform.dockerfile_template), self.staged_dockerfile)
+        log.debug("Building context for %s-%s (%s %s)", self.package.name,
+                  self.package.version, self.platform.os_name,
+                  self.platform.arch)
+
+        with tarfile_open(fileobj=buf, mode="w") as tar:
+            tar.add(abspath(self.package.name), arcname=".")
+            tar.add(
+                self.source_archive_path,
+                arcname=self.package.source_archive_name)
+            tar.add(
+                abspath(self.platform.dockerfile_template),
+                arcname="Dockerfile")
 
+        buf.seek(0)
+        return buf
+
+    def stage_files(self) -> None:
+        """
+        Assemble the build context for the Docker builder, downloading the
+        source archive if needed.
+        """
+        self.download_source_package()
+        self.context = self.build_context()
         self.staged = True
 
     def build(self) -> None:
@@ -353,18 +654,35 @@ class PackageBuild:
         if not self.staged:
             raise ValueError("Files have not been staged for building")
 
-        try:
-            self.image, build_logs = self.docker.images.build(
-                dockerfile=self.staged_dockerfile, path=self.build_dir,
-                rm=True, buildargs=self.buildargs)
-        except BuildError as e:
+        # The high-level images.build buffers the complete log list before
+        # returning anything; the low-level API streams entries as the
+        # daemon emits them, so output appears live and memory stays
+        # constant. Only a bounded tail is retained for the error report.
+        stream = self.docker.api.build(
+            fileobj=self.context, custom_context=True,
+            rm=True, buildargs=self.buildargs, decode=True)
+
+        image_id: Optional[str] = None
+        error_message: Optional[str] = None
+        log_tail: deque = deque(maxlen=LOG_TAIL_LINES)
+
+        for log_entry in stream:
+            log_tail.append(log_entry)
+            aux = self.handle_log_entries((log_entry,))
+            if "ID" in aux:
+                image_id = aux["ID"]
+            if "error" in log_entry:
+                error_message = log_entry["error"]
+
+        if error_message is not None or image_id is None:
+            if error_message is None:
+                error_message = "Build did not produce an image"
             log.error("Failed to build %s-%s (%s %s): %s", self.package.name,
                       self.package.version, self.platform.os_name,
-                      self.platform.arch, e)
-            self.handle_log_entries(e.build_log)
-            raise
+                      self.platform.arch, error_message)
+            raise BuildError(error_message, iter(log_tail))
 
-        self.handle_log_entries(build_logs)
+        self.image = self.docker.images.get(image_id)
 
     def export(self, dest_root: str) -> None:
         """
@@ -385,15 +703,11 @@ class PackageBuild:
 
             stdout = getattr(e, "stdout", None)
             if stdout:
-                m = LOG_STRIP_PATTERN.match(stdout.decode("utf-8"))
-                assert m
-                log.info("    %s", m.group(1))
+                log.info("    %s", tail_lines(stdout))
 
             stderr = getattr(e, "stderr", None)
             if stderr:
-                m = LOG_STRIP_PATTERN.match(stderr.decode("utf-8"))
-                assert m
-                log.error("    %s", m.group(1))
+                log.error("    %s", tail_lines(stderr))
             raise
         log.debug("Build logs: %s", logs)
 
@@ -411,14 +725,11 @@ class PackageBuild:
 
         for log_entry in logs:
             if "stream" in log_entry:
-                m = LOG_STRIP_PATTERN.match(log_entry["stream"])
-                assert m, "m failed to match %r" % log_entry["stream"]
-                log.info("    %s", m.group(1))
+                log.info("    %s", log_entry["stream"].strip(" \n"))
 
             if "errorDetail" in log_entry:
-                m = LOG_STRIP_PATTERN.match(log_entry["errorDetail"]["message"])
-                assert m
-                log.error("   %s", m.group(1))
+                log.error(
+                    "   %s", log_entry["errorDetail"]["message"].strip(" \n"))
 
             if "aux" in log_entry:
                 for key, value in log_entry["aux"].items():
@@ -427,48 +738,169 @@ class PackageBuild:
 
         return result
 
-def main(args: Sequence[str]) -> int:
+async def download_once(
+        session: "aiohttp.ClientSession", url: str, path: str,
+        events: Dict[str, AsyncEvent]) -> bool:
     """
-    The main entrypoint.
+    Download url to path unless it is already current on disk or another
+    task owns the download, in which case wait for that task to finish.
+    The return value indicates if a download was made.
+
+    Failures are logged, not raised: the URL is left unmarked in
+    source_state, so the threaded download path in stage_files retries it
+    during the build sweep and only that package's builds fail if the
+    retry fails too.
     """
-    log_config(
-        level=DEBUG,
-        format=("%(threadName)s %(asctime)s %(name)s:%(levelname)s "
-                "%(filename)s %(lineno)d: %(message)s"))
+    event = events.get(url)
+    if event is not None:
+        await event.wait()
+        return False
+
+    events[url] = event = AsyncEvent()
+    try:
+        makedirs(dirname(path), exist_ok=True)
+
+        async with session.head(url, allow_redirects=True) as resp:
+            content_length = resp.headers.get("Content-Length")
+
+        expected_size = (
+            int(content_length)
+            if content_length and content_length.isdigit() else None)
+
+        if (expected_size is not None and exists(path)
+                and getsize(path) == expected_size):
+            log.debug("Already downloaded %s (%d bytes)", url, expected_size)
+            downloaded = False
+        else:
+            log.debug("Downloading %s", url)
+            async with session.get(url) as resp:
+                resp.raise_for_status()
+                with open(path, "wb") as fd:
+                    async for chunk in resp.content.iter_chunked(
+                            READ_BUFFER_SIZE):
+                        fd.write(chunk)
+            downloaded = True
 
-    packages: List[Package] = []
-    package_root = abspath("./packages")
-    build_root = abspath("./builds")
-    dist_root = abspath("./dist")
+        with PackageBuild.download_cond:
+            PackageBuild.source_state[url] = SourcePackageState.Downloaded
 
-    if not exists(build_root):
-        mkdir(build_root)
+        return downloaded
+    except Exception as e:                  # pylint: disable=broad-except
+        log.warning("Pre-pass download of %s failed (will retry during "
+                    "the build sweep): %s", url, e)
+        return False
+    finally:
+        event.set()
 
-    if not exists(package_root):
-        mkdir(package_root)
 
-    if not exists(dist_root):
-        mkdir(dist_root)
+async def download_all(builds: Sequence[PackageBuild]) -> None:
+    """
+    Concurrently download every unique source archive needed by builds
+    through a single pooled aiohttp session. Completed downloads are
+    recorded in PackageBuild.source_state so the per-build staging path
+    skips them.
+    """
+    events: Dict[str, AsyncEvent] = {}
+    connector = aiohttp.TCPConnector(
+        limit=32, limit_per_host=4, keepalive_timeout=60)
 
-    log.debug("build_root: %s", build_root)
-    log.debug("package_root: %s", package_root)
+    # No total cap: aiohttp's default ClientTimeout(total=300) would abort
+    # any archive that takes more than five minutes. Connect and read
+    # timeouts still catch dead hosts.
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=60)
 
-    with open("packages.yaml", "r") as fd:
-        package_infos = yaml.safe_load(fd)
-        for package_info in package_infos:
-            packages.append(Package.from_yaml_config(package_info))
+    async with aiohttp.ClientSession(
+            connector=connector, timeout=timeout) as session:
+        await gather(*[
+            download_once(
+                session, pb.package.resolved_download_url,
+                pb.source_archive_path, events)
+            for pb in builds])
 
-    for platform in Platform:
-        for package in packages:
-            pb = PackageBuild(
-                package=package, platform=platform, build_root=build_root,
-                package_root=package_root, remove_build_dir=False)
 
-            pb.stage_files()
-            pb.build()
-            pb.export(dest_root=path_join(dist_root, platform.os_name))
+def run_build(package_build: PackageBuild, dest_root: str) -> None:
+    """
+    Run the stage/build/export pipeline for a single (package, platform)
+    combination. This is the unit of work submitted to the thread pool.
+    """
+    with package_build:
+        package_build.stage_files()
+        package_build.build()
+        package_build.export(dest_root=dest_root)
+
+
+def configure_logging() -> QueueListener:
+    """
+    Route all log records through a queue to a dedicated listener thread,
+    so worker threads hand a record off without blocking on formatting or
+    flushing. Returns the started listener; the caller must stop() it
+    before exiting to drain the queue.
+    """
+    stream_handler = StreamHandler()
+    stream_handler.setFormatter(Formatter(
+        "%(threadName)s %(asctime)s %(name)s:%(levelname)s "
+        "%(filename)s %(lineno)d: %(message)s"))
+
+    log_queue: SimpleQueue = SimpleQueue()
+    root_logger = getLogger()
+    root_logger.setLevel(DEBUG)
+    root_logger.addHandler(QueueHandler(log_queue))
 
-    return 0
+    listener = QueueListener(log_queue, stream_handler)
+    listener.start()
+    return listener
+
+
+def main(args: Sequence[str]) -> int:
+    """
+    The main entrypoint.
+    """
+    listener = configure_logging()
+
+    try:
+        package_root = abspath("./packages")
+        dist_root = abspath("./dist")
+
+        if not exists(package_root):
+            mkdir(package_root)
+
+        if not exists(dist_root):
+            mkdir(dist_root)
+
+        log.debug("package_root: %s", package_root)
+
+        packages = load_packages("packages.yaml")
+
+        builds = [
+            PackageBuild(
+                package=package, platform=platform,
+                package_root=package_root)
+            for platform in Platform
+            for package in packages]
+
+        if aiohttp is not None:
+            # Fetch every unique source archive up front with a single-
+            # threaded asyncio swarm so the build sweep starts with all
+            # archives local. Without aiohttp, the download path in
+            # stage_files handles this per-build instead.
+            asyncio_run(download_all(builds))
+
+        # The builds are I/O-bound (network downloads and waits on the
+        # Docker daemon), so run them concurrently. The download_cond/
+        # source_state machinery in PackageBuild already serializes
+        # concurrent downloads of the same package.
+        with ThreadPoolExecutor(max_workers=min(32, len(builds))) as executor:
+            futures = [
+                executor.submit(
+                    run_build, pb, path_join(dist_root, pb.platform.os_name))
+                for pb in builds]
+
+            for future in as_completed(futures):
+                future.result()
+
+        return 0
+    finally:
+        listener.stop()
 
 
 if __name__ == "__main__":